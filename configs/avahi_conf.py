@@ -7,6 +7,7 @@ from log2seq import preset
 
 CODEBASE_PATH = "../../../avahi"
 DATABASE_FILE = "avahi_db.pkl"
+EXCLUDED_DIRS = [ "tests" ]
 TEST_FILE = "./avahi.log"
 SPECIAL_RULES = {}
 LOGGING_FUNCTIONS = [
@@ -7,6 +7,7 @@ from log2seq import preset
 
 CODEBASE_PATH = "../../../dhcpcd"
 DATABASE_FILE = "dhcpcd_db.pkl"
+EXCLUDED_DIRS = [ "tests" ]
 TEST_FILE = "./dhcpcd.log"
 SPECIAL_RULES = {}
 LOGGING_FUNCTIONS = [
@@ -7,6 +7,7 @@ from log2seq import preset
 
 CODEBASE_PATH = "../frr/"
 DATABASE_FILE = "./data/frr_db.pkl"
+EXCLUDED_DIRS = [ "tests" ]
 TEST_FILE = "./sample_data/frr.log"
 LOGGING_FUNCTIONS = [
     { "name": "flog_err_sys", "format_string_pos": 1 },
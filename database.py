@@ -1,17 +1,26 @@
+from __future__ import annotations
+
+import csv
 import json
 import os.path
 import pickle
 import re
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
-from pathlib import Path
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from typing import TYPE_CHECKING
 
 import utils
 
-from amulog.lt_search import LTSearchTreeNew
-from log2seq._common import LogParser
+# Amulog is imported when a Database is created, and log2seq is only used through the parser of the config
+if TYPE_CHECKING:
+    from log2seq._common import LogParser
 
 
 def verbose_print(*args, **kwargs):
@@ -20,6 +29,13 @@ def verbose_print(*args, **kwargs):
 
 class Database:
     DEFAULT_DB_PATH = "db.pkl"
+    SNAPSHOT_VERSION = 4
+    OPEN_BUCKETS = 2  # Number of time buckets kept in memory by aggregate() before writing the oldest one
+    EXPORT_BATCH_SIZE = 10000  # Number of rows written per transaction by export_sqlite()
+    EXPORT_INSERT = "INSERT INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    FALLBACK_WORKERS = 2  # Number of threads running the non-blocking regex fallback
+    MAX_PENDING_FALLBACKS = 1000  # Beyond that many lines waiting for the background fallback, it runs inline
+    PATHOLOGICAL_LAZY_GROUPS = 3  # Templates with that many lazy groups are tried last by the fallback
 
     @staticmethod
     def benchmark(function, logs: list[str], title="bench_details", *args, **kwargs):
@@ -68,25 +84,167 @@ class Database:
 
         return total_time
 
+    def aggregate(self, lines: Iterable[str], output_path: str, bucket_seconds=3600, top_k=None, mode="first") -> dict:
+        """
+        Count the logs of each source call site per component and time bucket, and write the counters to
+        `output_path` (CSV) as the buckets are completed. Only the counters of the OPEN_BUCKETS latest buckets
+        are kept in memory, so memory does not depend on the number of lines. A bucket reopened by a late
+        line is written again later, and rows with the same key should then be summed.
+        With top_k, each bucket keeps at most top_k counters (Space-Saving sketch), the error column
+        bounding the overestimation of each count. A log whose template comes from several call sites is
+        counted for each of them; unmatched logs are counted with an empty call site.
+        """
+
+        stats = { "lines": 0, "unparsed": 0, "matched": 0 }
+        buckets: dict[int, utils.SpaceSaving] = {}
+
+        with open(output_path, "w", newline='', encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow([ "bucket", "component", "path", "function", "logging_line", "count", "error" ])
+
+            def flush(bucket):
+                start = datetime.fromtimestamp(bucket).isoformat()
+                for (component, path, function, logging_line), count, error in buckets.pop(bucket).items():
+                    writer.writerow([ start, component, path, function, logging_line, count, error ])
+                f.flush()
+
+            for line in lines:
+                stats["lines"] += 1
+
+                parsed = self.log2seq_parser.process_line(line)
+                if parsed is None:
+                    stats["unparsed"] += 1
+                    continue
+
+                bucket = int(parsed["timestamp"].timestamp() // bucket_seconds * bucket_seconds)
+                if bucket not in buckets:
+                    buckets[bucket] = utils.SpaceSaving(top_k)
+
+                matches = self._find_log_matches(parsed["message"], mode=mode)
+                component = parsed.get("component", "")
+
+                if not matches:
+                    buckets[bucket].add(( component, "", "", "" ))
+                else:
+                    stats["matched"] += 1
+                    for occurrences in matches.values():
+                        for occurrence in occurrences:
+                            buckets[bucket].add((
+                                component,
+                                occurrence["path"],
+                                occurrence.get("name", ""),  # Name of the calling function, if ctags found it
+                                occurrence["logging_line"],
+                            ))
+
+                if len(buckets) > Database.OPEN_BUCKETS:
+                    flush(min(buckets))
+
+            for bucket in sorted(buckets):
+                flush(bucket)
+
+        return stats
+
+    def export_sqlite(self, lines: Iterable[tuple[str, str]], sqlite_path: str, batch_size=EXPORT_BATCH_SIZE,
+                      mode="all") -> dict:
+        """
+        Match `lines`, pairs of (file, line) as given by read_log_lines(..., with_paths=True), and write one
+        row per line and origin to the `matches` table of a SQLite database, in transactions of `batch_size`
+        rows. Lines which cannot be parsed or matched get a single row without template or origin. Rows of
+        earlier exports are kept, except those of the files exported again which are replaced.
+        """
+
+        stats = { "lines": 0, "unparsed": 0, "matched": 0 }
+        rows = []
+
+        connection = sqlite3.connect(sqlite_path)
+        # The write-ahead log only syncs at checkpoints with synchronous = NORMAL, and a crash cannot
+        # corrupt the earlier exports
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS matches ("
+            "file TEXT, line INTEGER, timestamp TEXT, component TEXT, template TEXT, "
+            "path TEXT, function TEXT, logging_line INTEGER)"
+        )
+
+        def write_rows():
+            with connection:  # One transaction per batch
+                connection.executemany(Database.EXPORT_INSERT, rows)
+            rows.clear()
+
+        line_numbers: dict[str, int] = {}
+
+        try:
+            for file, line in lines:
+                stats["lines"] += 1
+
+                if file not in line_numbers:
+                    # Exporting the same file twice must not duplicate its rows
+                    with connection:
+                        connection.execute("DELETE FROM matches WHERE file = ?", ( file, ))
+                    line_numbers[file] = 0
+
+                # Lines are numbered from the start of their file
+                line_numbers[file] += 1
+                line_number = line_numbers[file]
+
+                parsed = self.log2seq_parser.process_line(line)
+                if parsed is None:
+                    stats["unparsed"] += 1
+                    rows.append(( file, line_number, None, None, None, None, None, None ))
+                    continue
+
+                timestamp = parsed["timestamp"].isoformat()
+                component = parsed.get("component")
+                matches = self._find_log_matches(parsed["message"], mode=mode)
+
+                if not matches:
+                    rows.append(( file, line_number, timestamp, component, None, None, None, None ))
+                else:
+                    stats["matched"] += 1
+
+                for template, occurrences in matches.items():
+                    template = getattr(template, "pattern", template)  # The regex fallback returns compiled regexes
+                    for occurrence in occurrences:
+                        rows.append((
+                            file, line_number, timestamp, component, template,
+                            occurrence["path"], occurrence.get("name"), occurrence["logging_line"],
+                        ))
+
+                if len(rows) >= batch_size:
+                    write_rows()
+
+            write_rows()
+            # Indexes are created once the first export is written, rather than updated for every row
+            connection.execute("CREATE INDEX IF NOT EXISTS matches_source ON matches (path, logging_line)")
+            connection.execute("CREATE INDEX IF NOT EXISTS matches_file ON matches (file)")
+            connection.commit()
+
+        finally:
+            connection.close()
+
+        return stats
+
     @staticmethod
-    def _find_logging_occurences_in_source(logging_functions: list[dict], codebase: str) -> list:
+    def _find_logging_occurences_in_source(logging_functions: list[dict], codebase: str, excluded_dirs=()) -> list:
         logging_files = []
-        all_c_file_paths = Path(codebase).rglob('*.c')
+        all_c_file_paths = utils.walk_source_files(codebase, ".c", excluded_dirs)
+
+        # A single pass over each file finds the call sites of every logging function at once
+        call_sites_regex = utils.compile_call_sites_regex(logging_functions)
 
         for i, path in enumerate(all_c_file_paths):
             with open(path, 'r', encoding="utf8", errors="ignore") as file:
                 source_code = file.read()
 
-            source_lines = source_code.split('\n')
+            call_sites = utils.find_call_sites(call_sites_regex, source_code)
 
             # Get line numbers for each file where any logging function appears
             for function in logging_functions:
-                if function["name"] not in source_code:
+                if function["name"] not in call_sites:
                     continue  # Skip it
 
-                line_numbers = utils.get_occurence_lines(function["name"], source_lines)
-
-                logging_files.append([ str(path), line_numbers, function ])
+                logging_files.append([ path, call_sites[function["name"]], function ])
 
             verbose_print('\rFiltering files for logging functions...', i, 'processed', end='')
 
@@ -167,7 +325,7 @@ class Database:
 
             try:
                 args = utils.extract_args(function_call)
-                regex_template, amulog_tpl = utils.extract_templates_from_format_string(
+                regex_template, amulog_tpl, variables = utils.extract_templates_from_format_string(
                     args[format_string_pos].replace("\n", ""),
                     occurrence["logging_function"],
                     special_rules
@@ -175,7 +333,11 @@ class Database:
             except ValueError:
                 continue  # We sometimes encounter logging functions that are invalid or useless, skip them
 
-            database.append(occurrence | { "template": re.compile(regex_template), "amulog_template": amulog_tpl })
+            database.append(occurrence | {
+                "template": re.compile(regex_template),
+                "amulog_template": amulog_tpl,
+                "variables": variables,
+            })
 
             verbose_print('\rGathering templates...', count, 'of', total, end=' ')
 
@@ -204,11 +366,26 @@ class Database:
         return templates_clean
 
     def __init__(self, codebase_path: str, db_path=None, verbose=False):
+        from amulog.lt_search import LTSearchTreeNew
+
         self.regexdb: dict[re.Pattern, list] = {}
         self.regextpl: list[re.Pattern] = []
+        self.regextpl_ordered: list[re.Pattern] = []
+        self.regex_hits: Counter[re.Pattern] = Counter()
+        self.regextpl_positions: dict[re.Pattern, int] = {}
+        self.regex_matchers: dict[re.Pattern, tuple[str, re.Pattern]] = {}
+        self.regex_worst_times: dict[re.Pattern, float] = {}
+        self.regex_variables: dict[re.Pattern, list[tuple[int, str | None]]] = {}
+        self.match_budget = None
+        self.budget_overruns = 0
+        self.wspt_lock = threading.Lock()
+        self.fallback_executor: ThreadPoolExecutor | None = None
+        self.pending_fallbacks: dict[tuple[str, ...], Future] = {}
+        self.pending_futures: set[Future] = set()
         self.amulog_templates_map: dict[str, set] = {}
         self.amulog_templates: list[str] = []
         self.wspt = LTSearchTreeNew()
+        self.wspt_pending: dict[int, list[int]] = {}
         self.codebase_path = codebase_path
         self.db_path = db_path or Database.DEFAULT_DB_PATH
         self.verbose_stream = sys.stderr if verbose else utils.NullStream()
@@ -217,62 +394,298 @@ class Database:
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         os.makedirs("benchmarks", exist_ok=True)
 
-    def build_db(self, logging_functions: list[dict], special_rules, force_rebuild=False, prefill_wspt=True):
+    def build_db(self, logging_functions: list[dict], special_rules, force_rebuild=False, prefill_wspt=True,
+                 excluded_dirs=(), lazy_wspt=False):
+        snapshot = None
+        changed = False
+
         if not force_rebuild and self.db_path and os.path.exists(self.db_path):
             # Load database
             with open(self.db_path, 'rb') as f:
-                templates_clean = pickle.load(f)
+                snapshot = pickle.load(f)
 
-        else:
+            if not isinstance(snapshot, dict) or snapshot.get("version") != Database.SNAPSHOT_VERSION:
+                verbose_print(f"Database snapshot {self.db_path} is outdated, rebuilding from source")
+                snapshot = None
+
+        if snapshot is None:
             # Construct database by parsing
-            logging_files = Database._find_logging_occurences_in_source(logging_functions, self.codebase_path)
+            logging_files = Database._find_logging_occurences_in_source(logging_functions, self.codebase_path, excluded_dirs)
             logs_callers = Database._find_logs_callers(logging_files)
             templates = Database._generate_templates(logs_callers, special_rules)
             templates_clean = Database._group_duplicates(templates)
 
-            with open(self.db_path, 'wb') as f:
-                pickle.dump(templates_clean, f)
+            snapshot = { "version": Database.SNAPSHOT_VERSION, "regexdb": templates_clean }
+            changed = True
 
         # amulogtpl_map is a dict which values are the keys in regexdb and regextpl
         # it is useful when we need to associate an amulog-style log to the corresponding regexes
-        self.regexdb = templates_clean
-        self.regextpl = list(self.regexdb.keys())
+        self.regexdb = snapshot["regexdb"]
+
+        if "regex_literals" in snapshot:
+            self.regextpl = snapshot["regextpl"]
+            self.regex_matchers = {
+                template: ( literal, Database._harden(template) )
+                for template, literal in snapshot["regex_literals"].items()
+            }
+        else:
+            self.regextpl = list(self.regexdb.keys())
+            self._analyze_templates()
+            changed = True
+
+        self._sort_templates()
 
         if prefill_wspt:
-            # Fill up self.amulogtpl_map with the amulog templates and their corresponding regex
-            for regex, occurence in templates_clean.items():
-                amulog_tpl = occurence[0]["amulog_template"]
+            if "wspt" in snapshot:
+                # The tree and its index arrays were stored along with the templates, restore them as is
+                self.amulog_templates = snapshot["amulog_templates"]
+                self.amulog_templates_map = snapshot["amulog_templates_map"]
+                self.wspt = snapshot["wspt"]
+                self.wspt_pending = snapshot["wspt_pending"]
+
+                if not lazy_wspt:
+                    for words_count in list(self.wspt_pending):
+                        self._fill_wspt_bucket(words_count)
+
+            else:
+                self._prefill_wspt(lazy_wspt)
+                changed = True
+
+        if changed:
+            self.save_snapshot()
+
+    def save_snapshot(self, path=None):
+        """
+        Store the templates, the WSPT and its index arrays (including templates learned by the regex
+        fallback) so that the next start can restore them without rebuilding anything.
+        """
+
+        snapshot = {
+            "version": Database.SNAPSHOT_VERSION,
+            "regexdb": self.regexdb,
+            "regextpl": self.regextpl,
+            # Hardened matchers are rebuilt on load, as they may rely on features of the running Python
+            "regex_literals": { template: literal for template, (literal, _) in self.regex_matchers.items() },
+        }
+
+        if self.amulog_templates:
+            snapshot |= {
+                "amulog_templates": self.amulog_templates,
+                "amulog_templates_map": self.amulog_templates_map,
+                "wspt": self.wspt,
+                "wspt_pending": self.wspt_pending,
+            }
+
+        with open(path or self.db_path, 'wb') as f:
+            pickle.dump(snapshot, f)
+
+    @staticmethod
+    def _harden(template: re.Pattern) -> re.Pattern:
+        hardened = utils.harden_template(template.pattern)
+        return template if hardened == template.pattern else re.compile(hardened, template.flags)
+
+    def _analyze_templates(self):
+        pathological = set()
+
+        for template in self.regextpl:
+            matcher = Database._harden(template)
+
+            # Lines which do not contain the longest literal of a template are discarded without running it
+            self.regex_matchers[template] = ( utils.longest_literal(template.pattern), matcher )
+
+            if utils.count_lazy_groups(matcher.pattern) >= Database.PATHOLOGICAL_LAZY_GROUPS:
+                pathological.add(template)
 
-                if amulog_tpl not in self.amulog_templates_map:
-                    self.amulog_templates_map[amulog_tpl] = set()
+        # Templates prone to backtracking are deferred to the end of the exhaustive fallback
+        self.regextpl.sort(key=lambda template: template in pathological)
 
-                self.amulog_templates_map[amulog_tpl].add(regex)
+        verbose_print(len(pathological), "templates prone to backtracking")
 
-            # Now fill up the data structure with the templates (tree is recommended)
-            self.amulog_templates = list(self.amulog_templates_map.keys())
-            for i, amulog_template in enumerate(self.amulog_templates):
-                words = amulog_template.split(" ")
+    def _prefill_wspt(self, lazy=False):
+        # Fill up self.amulogtpl_map with the amulog templates and their corresponding regex
+        for regex, occurence in self.regexdb.items():
+            amulog_tpl = occurence[0]["amulog_template"]
+
+            if amulog_tpl not in self.amulog_templates_map:
+                self.amulog_templates_map[amulog_tpl] = set()
+
+            self.amulog_templates_map[amulog_tpl].add(regex)
+
+        # Now fill up the data structure with the templates (tree is recommended)
+        self.amulog_templates = list(self.amulog_templates_map.keys())
+        for i, amulog_template in enumerate(self.amulog_templates):
+            words = amulog_template.split(" ")
+
+            if lazy:
+                # A wildcard stands for exactly one word, so a log can only match templates of the same
+                # length: the templates are only inserted once a log of their length is searched
+                self.wspt_pending.setdefault(len(words), []).append(i)
+            else:
                 self.wspt.add(i, words)
 
+    def _fill_wspt_bucket(self, words_count: int):
+        for i in self.wspt_pending.pop(words_count, ()):
+            self.wspt.add(i, self.amulog_templates[i].split(" "))
+
     def set_log2seq_parser(self, log2seq_parser: LogParser):
         self.log2seq_parser = log2seq_parser
 
-    def _find_regex_matches(self, log: str, regex_templates: set[re.Pattern]) -> dict[str, list]:
+    def set_match_budget(self, seconds):
+        """
+        Limit the time spent by the regex fallback on a single line. Once exceeded, the remaining candidates
+        are skipped and the line only gets the matches found so far. None disables the limit. The templates
+        of such a line are not learned by the WSPT, so that the next lines of that shape try all the candidates.
+        The budget is checked between two templates: a single regex that backtracks is never interrupted,
+        and can still exceed it on its own. The matching times of the templates are only recorded (for
+        report_worst_templates) while a budget is set.
+        """
+
+        self.match_budget = seconds
+
+    def report_worst_templates(self, n=10) -> list[tuple[str, int, float]]:
+        """
+        Print the `n` templates with the worst matching time observed by the fallback. Times are only
+        recorded while a match budget is set, see set_match_budget().
+        """
+
+        worst = sorted(
+            (
+                ( template.pattern, utils.count_lazy_groups(matcher.pattern), self.regex_worst_times.get(template, 0) )
+                for template, (_, matcher) in self.regex_matchers.items()
+            ),
+            key=lambda item: ( item[2], item[1] ),
+            reverse=True
+        )[:n]
+
+        verbose_print(f"Worst templates ({self.budget_overruns} lines exceeded the matching budget):")
+        for pattern, lazy_groups, worst_time in worst:
+            verbose_print(f" - {worst_time:f} sec, {lazy_groups} lazy groups: /{pattern}/")
+
+        return worst
+
+    def _match_template(self, template: re.Pattern, log: str):
+        literal, matcher = self.regex_matchers[template]
+
+        if literal not in log:
+            return None
+
+        return matcher.match(log)
+
+    def _iter_template_matches(self, log: str, candidates: list[re.Pattern], skipped: list | None = None):
+        # Candidates left untried when the budget runs out are added to `skipped`
+        if self.match_budget is None:
+            for template in candidates:
+                matchobj = self._match_template(template, log)
+                if matchobj:
+                    yield template, matchobj
+            return
+
+        start = time.perf_counter()
+        for i, template in enumerate(candidates):
+            tic = time.perf_counter()
+            matchobj = self._match_template(template, log)
+            toc = time.perf_counter()
+
+            if toc - tic > self.regex_worst_times.get(template, 0):
+                self.regex_worst_times[template] = toc - tic
+
+            if matchobj:
+                yield template, matchobj
+
+            if toc - start > self.match_budget and i + 1 < len(candidates):
+                self.budget_overruns += 1
+                if skipped is not None:
+                    skipped.extend(candidates[i + 1:])
+                return
+
+    def _template_rank(self, template: re.Pattern) -> tuple:
+        # Most specific templates first (latest first lazy group), the most frequently hit ones among those
+        # equally specific: a generic template can thus never shadow a more specific one
+        return -utils.template_sorter(template.pattern), -self.regex_hits[template]
+
+    def _sort_templates(self):
+        self.regextpl_ordered = sorted(self.regextpl, key=self._template_rank)
+        self.regextpl_positions = { template: i for i, template in enumerate(self.regextpl_ordered) }
+
+    def _record_hit(self, template: re.Pattern):
+        self.regex_hits[template] += 1
+
+        position = self.regextpl_positions.get(template)
+        ordered = self.regextpl_ordered
+        if not position or ordered[position] is not template:
+            return
+
+        rank = self._template_rank(template)
+        if rank >= self._template_rank(ordered[position - 1]):
+            return
+
+        # The template now outranks its predecessors: move it up as in an insertion sort. The list is
+        # replaced rather than modified, so that a concurrent fallback keeps iterating on a consistent order
+        with self.wspt_lock:
+            ordered = list(self.regextpl_ordered)
+            position = self.regextpl_positions[template]
+            while position > 0 and rank < self._template_rank(ordered[position - 1]):
+                ordered[position] = ordered[position - 1]
+                self.regextpl_positions[ordered[position]] = position
+                position -= 1
+
+            ordered[position] = template
+            self.regextpl_positions[template] = position
+            self.regextpl_ordered = ordered
+
+    def _make_result(self, template: re.Pattern, matchobj: re.Match, variables: bool):
+        if not variables:
+            return self.regexdb[template]
+
+        # The occurrences of a template may have different specifiers for the same group (e.g. %d and %o)
+        specs = self.regex_variables.get(template)
+        if specs is None:
+            specs = utils.merge_variable_specs([ occurrence["variables"] for occurrence in self.regexdb[template] ])
+            self.regex_variables[template] = specs
+
+        return {
+            "origins": self.regexdb[template],
+            "variables": [ utils.convert_variable(spec, matchobj.group(group)) for group, spec in specs ],
+        }
+
+    def _find_regex_matches(self, log: str, regex_templates: set[re.Pattern], mode="all", variables=False) -> dict[str, list]:
+        if mode == "first":
+            regex_templates = sorted(regex_templates, key=self._template_rank)
+
         res = {}
         for template in regex_templates:
-            if template.match(log):
-                res[template.pattern] = self.regexdb[template]
+            matchobj = self._match_template(template, log)
+            if matchobj:
+                res[template.pattern] = self._make_result(template, matchobj, variables)
+                self._record_hit(template)
+
+                if mode == "first":
+                    break
         return res
 
-    def find_matches(self, line: str, regex_fallback=True):
+    def find_matches(self, line: str, regex_fallback=True, mode="all", blocking=True, variables=False):
+        """
+        Return the regex templates matching `line` along with their origins in the source code. With
+        mode="all", every matching template is returned; with mode="first", only the most likely one.
+        With variables=True, each template maps to { "origins": [...], "variables": [...] } where the
+        variables are the values of the format specifiers, converted according to their type.
+        With blocking=False, a log missed by the WSPT is handed to the background fallback and a
+        concurrent.futures.Future of the result is returned right away.
+        """
+
         parsed = self.log2seq_parser.process_line(line)
         if parsed is None:
             return { }
 
-        log = parsed["message"]
+        return self._find_log_matches(parsed["message"], regex_fallback, mode, blocking, variables)
 
+    def _find_log_matches(self, log: str, regex_fallback=True, mode="all", blocking=True, variables=False):
         words = utils.log2words(log)
 
+        if self.wspt_pending:
+            with self.wspt_lock:
+                self._fill_wspt_bucket(len(words))
+
         tpl_index = self.wspt.search(words)
 
         if tpl_index is not None:
@@ -280,53 +693,144 @@ class Database:
             amulog_tpl = self.amulog_templates[tpl_index]  # Amulog template corresponding to the index
 
             if regex_fallback and utils.is_generic_amulog(amulog_tpl):
-                return self._fallback_regex_matching(log)
+                return self._run_fallback(log, words, mode, blocking, variables)
 
             # Retreive all the regex templates associated with that amulog template
             regex_candidates = self.amulog_templates_map[amulog_tpl]
 
-            matching_regexes = self._find_regex_matches(log, regex_candidates)
+            matching_regexes = self._find_regex_matches(log, regex_candidates, mode, variables)
 
             return matching_regexes
         else:
             if regex_fallback:
                 # The Amulog-tree based approach did not find any match for the log, we fallback on the slow
                 # but exhaustive regex matching and will create new amulog templates based on our results
-                return self._fallback_regex_matching(log)
+                return self._run_fallback(log, words, mode, blocking, variables)
 
             else:
                 return { }
 
-    def find_regex_matches(self, line: str, regex_templates: set[re.Pattern]) -> dict[str, list]:
+    def find_regex_matches(self, line: str, regex_templates: set[re.Pattern], mode="all", variables=False) -> dict[str, list]:
         parsed = self.log2seq_parser.process_line(line)
 
         if parsed is None:
             return { }
 
         log = parsed["message"]
-        return self._find_regex_matches(log, regex_templates)
+        return self._find_regex_matches(log, regex_templates, mode, variables)
+
+    def _run_fallback(self, log: str, words: list[str], mode: str, blocking: bool, variables: bool):
+        if blocking:
+            return self._fallback_regex_matching(log, mode, variables)
+
+        future = Future()
+        leader = None
+        queued = False
+
+        with self.wspt_lock:
+            if len(self.pending_futures) < Database.MAX_PENDING_FALLBACKS:
+                queued = True
+                self.pending_futures.add(future)
+                shape = utils.words_shape(words)
+                leader = self.pending_fallbacks.get(shape)
+
+                if leader is None or leader.done():
+                    leader = None
+                    if self.fallback_executor is None:
+                        self.fallback_executor = ThreadPoolExecutor(Database.FALLBACK_WORKERS)
+
+                    self.pending_fallbacks[shape] = future
+                    self.fallback_executor.submit(self._resolve_fallback, future, shape, log, mode, variables)
+
+        if not queued:
+            # Too many lines are waiting already: the caller is slowed down rather than the queue growing
+            future.set_result(self._fallback_regex_matching(log, mode, variables))
+
+        elif leader is not None:
+            # A line of the same shape is being processed: its templates will likely match this one too,
+            # so the line is only looked up again once they are learned, instead of running the fallback twice.
+            # The callback may run right away in this thread, it only hands the line over to the workers
+            leader.add_done_callback(lambda _: self._follow_fallback(leader, future, log, mode, variables))
+
+        return future
+
+    def _follow_fallback(self, leader: Future, future: Future, log: str, mode: str, variables: bool):
+        if leader.exception() is None and not leader.result():
+            # No template matches that shape: the fallback would not find more for this line
+            future.set_result({ })
+            with self.wspt_lock:
+                self.pending_futures.discard(future)
+        else:
+            self.fallback_executor.submit(self._resolve_fallback, future, None, log, mode, variables)
 
-    def _fallback_regex_matching(self, log: str):
+    def _resolve_fallback(self, future: Future, shape: tuple[str, ...] | None, log: str, mode: str, variables: bool):
+        result = error = None
+        try:
+            if shape is None:
+                result = self._find_log_matches(log, True, mode, True, variables)
+            else:
+                result = self._fallback_regex_matching(log, mode, variables)
+
+        except Exception as err:
+            error = err
+
+        # The shape is released before the followers are notified, so that a line of that shape arriving
+        # in between becomes a new leader instead of following a finished one
+        if shape is not None:
+            with self.wspt_lock:
+                del self.pending_fallbacks[shape]
+
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+        with self.wspt_lock:
+            self.pending_futures.discard(future)
+
+    def wait_pending(self):
+        """
+        Wait for the background fallbacks in progress, e.g. before saving a snapshot. Their results are
+        given by the futures returned by find_matches().
+        """
+
+        with self.wspt_lock:
+            futures = list(self.pending_futures)
+
+        wait(futures)
+
+    def _fallback_regex_matching(self, log: str, mode="all", variables=False):
         """
         Fallback method for exhaustive regex matching and creating new amulog templates.
+        With mode="first", candidates are tried by rank and the search stops at the first verified match.
         """
 
-        templates = set()
+        matching_regexes, new_templates = self._find_fallback_templates(log, mode, variables)
+        if new_templates is not None:
+            self._learn_templates(new_templates)
+
+        return matching_regexes
+
+    def _find_fallback_templates(self, log: str, mode="all", variables=False) -> tuple[dict, list[tuple[str, re.Pattern]] | None]:
+
+        candidates = self.regextpl_ordered if mode == "first" else self.regextpl
+        skipped = []
 
         # We iterate on Amulog templates in order to have the connection with their corresp. regex templates
-        for regex_template in self.regextpl:
-            if regex_template.match(log):
-                templates.add(( regex_template, self.regexdb[regex_template][0]["amulog_template"] ))
+        # Matches are produced lazily so that the first mode does not test the remaining candidates
+        templates = (
+            ( regex_template, self.regexdb[regex_template][0]["amulog_template"], matchobj )
+            for regex_template, matchobj in self._iter_template_matches(log, candidates, skipped)
+        )
 
         matching_regexes = {}
+        new_templates = []
 
-        # Now we create and insert new templates into the tree
-        min_id = len(self.amulog_templates)
-        i = 0
+        # Now we create the new templates, they are inserted into the tree by _learn_templates
         flag = False
-        for (regex_template, amulog_template, *_) in templates:
+        for (regex_template, amulog_template, matchobj) in templates:
             try:
-                new_amulog = utils.reformat_template(regex_template, log)
+                new_amulog = utils.reformat_template(regex_template, log, matchobj)
             except AssertionError:
                 # The regex matches but Amulog failed to produce a working modified template
                 print(f'Cannot adjust template "{amulog_template}" for log: "{log}". Corresponding '
@@ -335,20 +839,39 @@ class Database:
                 continue
 
             # Return the subset containing regexes Amulog is able to use (the rest is usually false positives)
-            matching_regexes[regex_template] = self.regexdb[regex_template]
+            matching_regexes[regex_template] = self._make_result(regex_template, matchobj, variables)
+            self._record_hit(regex_template)
 
-            # if not utils.is_generic_amulog(new_amulog):
-            # If the new amulog template is not "generic" (eg, ** ** ** **) then add it to the tree
-            self.wspt.add(min_id + i, new_amulog.split(" "))
-            i += 1
+            new_templates.append(( new_amulog, regex_template ))
 
-            # And into the rest of the database
-            self.amulog_templates.append(new_amulog)
-            if new_amulog not in self.amulog_templates_map:
-                self.amulog_templates_map[new_amulog] = set()
-            self.amulog_templates_map[new_amulog].add(regex_template)
+            if mode == "first":
+                break
 
         if flag:
             verbose_print(matching_regexes)
 
-        return matching_regexes
+        if skipped:
+            # The budget ran out before all the candidates were tried: learning the templates found so far
+            # would send the next logs of that shape to this partial set only, the next log will try again
+            return matching_regexes, None
+
+        return matching_regexes, new_templates
+
+    def _learn_templates(self, new_templates: list[tuple[str, re.Pattern]]):
+        # The index arrays are updated before the tree, so that a concurrent search never finds a template id
+        # that does not exist yet. The sets of the map are replaced rather than modified for the same reason
+        with self.wspt_lock:
+            for new_amulog, regex_template in new_templates:
+                known = self.amulog_templates_map.get(new_amulog)
+
+                if known is None:
+                    self.amulog_templates.append(new_amulog)
+                    self.amulog_templates_map[new_amulog] = { regex_template }
+
+                    # if not utils.is_generic_amulog(new_amulog):
+                    # If the new amulog template is not "generic" (eg, ** ** ** **) then add it to the tree
+                    self.wspt.add(len(self.amulog_templates) - 1, new_amulog.split(" "))
+
+                elif regex_template not in known:
+                    # The template is already in the tree, only its candidates change
+                    self.amulog_templates_map[new_amulog] = known | { regex_template }
@@ -0,0 +1,118 @@
+import glob
+import gzip
+import io
+import lzma
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_SIZE = 10000  # Number of lines sent at once by the decompression threads
+READ_AHEAD = 8      # Number of chunks each file can have ready in advance
+ROTATION_INDEX = re.compile(r"\.(\d+)(?:\.(?:gz|xz|lzma|zst))?$")
+
+
+def open_log_file(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf8", errors="replace")
+
+    elif path.endswith((".xz", ".lzma")):
+        return lzma.open(path, "rt", encoding="utf8", errors="replace")
+
+    elif path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"Reading {path} requires the zstandard package (pip install zstandard)")
+
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True, read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding="utf8", errors="replace")
+
+    else:
+        return open(path, "r", encoding="utf8", errors="replace")
+
+
+def rotation_index(path: str) -> int:
+    # The current file has no index, the higher the index the older the file
+    match = ROTATION_INDEX.search(path)
+    return int(match.group(1)) if match else 0
+
+
+def expand_log_paths(patterns: list[str]) -> list[str]:
+    paths = set()
+    for pattern in patterns:
+        matches = [ path for path in glob.glob(pattern) if os.path.isfile(path) ]
+        if not matches:
+            raise FileNotFoundError(f"No log file matches {pattern}")
+        paths.update(matches)
+
+    # Rotated files (frr.log.2.gz, frr.log.1.gz, frr.log) are read from the oldest to the most recent
+    return sorted(paths, key=lambda path: ( -rotation_index(path), path ))
+
+
+def _put(chunks: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_chunks(path: str, chunks: queue.Queue, stop: threading.Event, chunk_size: int):
+    try:
+        with open_log_file(path) as f:
+            chunk = []
+            for line in f:
+                chunk.append(line.rstrip("\n"))
+
+                if len(chunk) >= chunk_size:
+                    if not _put(chunks, chunk, stop):
+                        return
+                    chunk = []
+
+            if chunk and not _put(chunks, chunk, stop):
+                return
+
+        _put(chunks, None, stop)  # End of file
+
+    except Exception as err:
+        _put(chunks, err, stop)
+
+
+def read_log_lines(patterns: list[str], workers=2, chunk_size=CHUNK_SIZE, read_ahead=READ_AHEAD, with_paths=False):
+    """
+    Yield the lines of all the files matching the glob `patterns`, compressed (.gz, .xz, .zst) or not.
+    Up to `workers` files are decompressed by background threads while the lines are consumed, each of
+    them keeping at most `read_ahead` chunks of `chunk_size` lines in advance. With with_paths=True,
+    pairs of (path, line) are yielded instead.
+    """
+
+    paths = expand_log_paths(patterns)
+    stop = threading.Event()
+
+    # Files are submitted in order, so the file being consumed is always one of those being read
+    files_chunks = [ queue.Queue(maxsize=read_ahead) for _ in paths ]
+    executor = ThreadPoolExecutor(max(1, workers))
+
+    try:
+        for path, chunks in zip(paths, files_chunks):
+            executor.submit(_read_chunks, path, chunks, stop, chunk_size)
+
+        for path, chunks in zip(paths, files_chunks):
+            while (chunk := chunks.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+
+                if with_paths:
+                    yield from ( ( path, line ) for line in chunk )
+                else:
+                    yield from chunk
+
+    finally:
+        # Also stops the threads when the caller does not read all the lines
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
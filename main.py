@@ -3,6 +3,7 @@ import random
 import importlib
 
 from database import Database
+from logfiles import read_log_lines
 
 
 if __name__ == "__main__":
@@ -10,6 +11,15 @@ if __name__ == "__main__":
     parser.add_argument('-c', "--conf", type=str, help='Specify configuration file', required=True)
     parser.add_argument('-b', "--benchmark", action='store_true', help='Run benchmarks')
     parser.add_argument('-f', "--forcerebuild", action='store_true', help='Force rebuilding the database from source')
+    parser.add_argument('-l', "--lazywspt", action='store_true', help='Only insert templates into the WSPT when needed')
+    parser.add_argument('-t', "--timebudget", type=float, help='Maximum time (in seconds) of the regex fallback per log')
+    parser.add_argument('-m', "--match", type=str, help='Print the origins of a single log line')
+    parser.add_argument('-i', "--input", type=str, nargs='+', help='Log files to read instead of the test file of the '
+                        'config (globs and .gz/.xz/.zst files are supported)')
+    parser.add_argument('-a', "--aggregate", type=str, help='Write the number of logs per call site and per hour to a CSV file')
+    parser.add_argument('-e', "--export", type=str, help='Write the matches of every log to a SQLite database')
+    parser.add_argument("--bucket", type=int, default=3600, help='Duration (in seconds) of the aggregation time buckets')
+    parser.add_argument("--topk", type=int, help='Only keep the top K call sites of each time bucket when aggregating')
     args = parser.parse_args()
 
     conf = importlib.import_module(args.conf.replace("/", ".").replace(".py", ""))
@@ -19,12 +29,31 @@ if __name__ == "__main__":
 
     db = Database(conf.CODEBASE_PATH, conf.DATABASE_FILE)
 
-    db.build_db(conf.LOGGING_FUNCTIONS, conf.SPECIAL_RULES, force_rebuild=FORCE_REBUILD, prefill_wspt=True)
+    db.build_db(conf.LOGGING_FUNCTIONS, conf.SPECIAL_RULES, force_rebuild=FORCE_REBUILD, prefill_wspt=True,
+                excluded_dirs=getattr(conf, "EXCLUDED_DIRS", ()), lazy_wspt=args.lazywspt)
     db.set_log2seq_parser(conf.log_parser)
+    db.set_match_budget(args.timebudget)
+
+    if args.match:
+        for template, occurrences in db.find_matches(args.match).items():
+            print(getattr(template, "pattern", template))  # The regex fallback returns compiled regexes
+            for occurrence in occurrences:
+                print(f"  {occurrence['path']}:{occurrence['logging_line']} {occurrence.get('name', '')}")
+
+    input_files = args.input or [ conf.TEST_FILE ]
+
+    if args.aggregate:
+        stats = db.aggregate(read_log_lines(input_files), args.aggregate, bucket_seconds=args.bucket, top_k=args.topk)
+
+        print(f"{stats['matched']} of {stats['lines']} logs matched ({stats['unparsed']} unparsed)")
+
+    if args.export:
+        stats = db.export_sqlite(read_log_lines(input_files, with_paths=True), args.export)
+
+        print(f"{stats['matched']} of {stats['lines']} logs matched ({stats['unparsed']} unparsed)")
 
     if RUN_BENCHMARKS:
-        with open(conf.TEST_FILE, "r", encoding="utf8") as f:
-            logs = f.read().strip("\n").split("\n")
+        logs = [ line for line in read_log_lines(input_files) if line ]
 
         random.shuffle(logs)
 
@@ -35,6 +64,8 @@ if __name__ == "__main__":
 
         try:
             db.benchmark(db.find_matches, test_logs, title="scolm", regex_fallback=True)
+            if args.timebudget is not None:
+                db.report_worst_templates()
 
         except KeyboardInterrupt:
             print("Stopped")
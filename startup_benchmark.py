@@ -0,0 +1,63 @@
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)$")
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int, int]]:
+    imports = []
+    for line in stderr.split("\n"):
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+
+        self_us, cumulative_us, indent, name = match.groups()
+        # Nested imports are indented by two spaces per level
+        imports.append(( name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2 ))
+
+    return imports
+
+
+def run_once(conf: str, line: str) -> tuple[float, list]:
+    command = [ sys.executable, "-X", "importtime", "main.py", "-c", conf, "-m", line ]
+
+    tic = time.perf_counter()
+    process = subprocess.run(command, capture_output=True, text=True)
+    toc = time.perf_counter()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"main.py failed:\n{process.stderr}")
+
+    return toc - tic, parse_importtime(process.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the time to the first match of a single line")
+    parser.add_argument('-c', "--conf", type=str, help='Specify configuration file', required=True)
+    parser.add_argument('-l', "--line", type=str, help='Log line to match', required=True)
+    parser.add_argument('-r', "--repeat", type=int, default=5, help='Number of runs')
+    parser.add_argument('-n', "--top", type=int, default=15, help='Number of imports to report')
+    args = parser.parse_args()
+
+    # The first run also warms up the caches (bytecode, file system), it is not measured
+    run_once(args.conf, args.line)
+
+    durations = []
+    imports = []
+    for _ in range(args.repeat):
+        duration, imports = run_once(args.conf, args.line)
+        durations.append(duration)
+
+    top_level = [ item for item in imports if item[3] == 0 ]
+    total_imports = sum(cumulative for _, _, cumulative, _ in top_level)
+
+    print(f"Time to first match (median of {args.repeat} runs):\t{statistics.median(durations):f} sec")
+    print(f"Time spent importing modules (last run):\t{total_imports / 1e6:f} sec")
+    print("Slowest top-level imports:")
+    for name, _, cumulative, _ in sorted(top_level, key=lambda item: item[2], reverse=True)[:args.top]:
+        print(f"\t{cumulative / 1e6:f} sec\t{name}")
@@ -1,7 +1,17 @@
+import bisect
+import heapq
+import itertools
 import math
+import os
 import re
+import string
+import sys
 
-import numpy
+try:
+    from re import _constants as sre_constants, _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_constants
+    import sre_parse
 
 
 FORMAT_SPECIFIER_GENERIC = r"\%(?P<flags>[ 0#+-]?)"             \
@@ -12,6 +22,15 @@ FORMAT_SPECIFIER_GENERIC = r"\%(?P<flags>[ 0#+-]?)"             \
 
 MEANINGLESS_STRS = [ ':', ' ', '->' ]
 
+LAZY_GROUP = "(.*?)"
+DIGIT = re.compile(r"\d")
+
+# Repetitions produced by format_specifier_to_regex, and the characters each of them can consume
+POSSESSIVE_CANDIDATES = {
+    r"\d+": string.digits,
+    r"[0-9a-fA-F]+": string.hexdigits,
+}
+
 
 class NullStream:
     def write(self, *args, **kwargs):
@@ -24,17 +43,104 @@ class NullStream:
         ...
 
 
-def get_occurence_lines(function, source_lines):
-    line_numbers = []
+class SpaceSaving:
+    """
+    Heavy hitters counter keeping at most `size` keys (Metwally et al., Space-Saving algorithm).
+    The count of a key is overestimated by at most its error. With size=None, all the keys are kept.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.counts = {}
+        self.errors = {}
+        # Min-heap of (count, order, key) to find the smallest key. Entries are not updated in place: an entry
+        # whose count is outdated is skipped when popped, and the heap is rebuilt once it holds too many
+        self.heap = []
+        self.order = itertools.count()
+
+    def _push(self, key):
+        if self.size is None:
+            return  # Nothing is ever evicted
+
+        heapq.heappush(self.heap, ( self.counts[key], next(self.order), key ))
+
+        if len(self.heap) > 2 * self.size:
+            self.heap = [ ( count, next(self.order), key ) for key, count in self.counts.items() ]
+            heapq.heapify(self.heap)
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+
+        elif self.size is None or len(self.counts) < self.size:
+            self.counts[key] = count
+            self.errors[key] = 0
+
+        else:
+            # The new key replaces the smallest one, and inherits its count as error
+            while True:
+                minimum, _, smallest = heapq.heappop(self.heap)
+                if self.counts.get(smallest) == minimum:
+                    break
+
+            del self.counts[smallest]
+            del self.errors[smallest]
+
+            self.counts[key] = minimum + count
+            self.errors[key] = minimum
+
+        self._push(key)
+
+    def items(self):
+        for key, count in self.counts.items():
+            yield key, count, self.errors[key]
 
-    # Skip wrapper functions (vnc_zlog_debug_verbose for zlog_debug for example)
-    regex = re.compile(fr"(?<!\w){function}[ |\n|\t]*\(")
 
-    for line_number, line in enumerate(source_lines):
-        if regex.search(line):
-            line_numbers.append(line_number + 1)
+def compile_call_sites_regex(logging_functions: list[dict]) -> re.Pattern:
+    # Longest names first so that e.g. flog_err_sys is tried before flog_err
+    names = sorted({ function["name"] for function in logging_functions }, key=len, reverse=True)
+    alternation = '|'.join(map(re.escape, names))
 
-    return line_numbers
+    # Skip wrapper functions (vnc_zlog_debug_verbose for zlog_debug for example), and only accept a
+    # parenthesis on the same line as the name, as the template extraction expects
+    return re.compile(fr"(?<!\w)(?P<name>{alternation})[ \t]*\(")
+
+
+def find_call_sites(regex: re.Pattern, source_code: str) -> dict[str, list[int]]:
+    # Offsets of the beginning of each line, used to map a match offset to its line number
+    line_starts = [ 0 ]
+    index = source_code.find('\n')
+    while index != -1:
+        line_starts.append(index + 1)
+        index = source_code.find('\n', index + 1)
+
+    call_sites = {}
+    for match in regex.finditer(source_code):
+        line_number = bisect.bisect_right(line_starts, match.start())
+        line_numbers = call_sites.setdefault(match.group("name"), [])
+
+        # Several calls on the same line are reported once
+        if not line_numbers or line_numbers[-1] != line_number:
+            line_numbers.append(line_number)
+
+    return call_sites
+
+
+def walk_source_files(root: str, extension=".c", excluded_dirs=()):
+    stack = [ root ]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in excluded_dirs:
+                        stack.append(entry.path)
+                elif entry.name.endswith(extension) and entry.is_file():
+                    yield entry.path
 
 
 def find_caller(line_number, ctags_data):
@@ -125,12 +231,23 @@ def format_specifier_to_regex(match) -> str:
     return regex
 
 
-def regexify_format_str(string, logging_function):
+def regexify_format_str(string, logging_function) -> tuple[str, list[tuple[int, str]]]:
     res = ""
     i = 0
+
+    # Capture group of each format specifier in the final regex, along with the specifier's conversion
+    variables = []
+    groups_count = re.compile(logging_function["prefix"]).groups if "prefix" in logging_function else 0
+
     for match in re.finditer(FORMAT_SPECIFIER_GENERIC, string):
+        specifier_regex = format_specifier_to_regex(match)
+
         res += re.escape(string[i:match.start()])
-        res += format_specifier_to_regex(match)
+        res += specifier_regex
+
+        # The value is always the first group of the specifier's regex (float regexes can have more)
+        variables.append(( groups_count + 1, match.group("spec") ))
+        groups_count += re.compile(specifier_regex).groups
 
         i = match.end()
 
@@ -142,7 +259,7 @@ def regexify_format_str(string, logging_function):
     if "suffix" in logging_function:
         res = res + logging_function["suffix"]
 
-    return "^" + res + "$"
+    return "^" + res + "$", variables
 
 
 def extract_args(code: str) -> list[str]:
@@ -195,7 +312,7 @@ def extract_args(code: str) -> list[str]:
     return args
 
 
-def extract_templates_from_format_string(format_string: str, logging_function: dict, special_rules: dict[str, str]) -> tuple[str, str]:
+def extract_templates_from_format_string(format_string: str, logging_function: dict, special_rules: dict[str, str]) -> tuple[str, str, list]:
     format_string_clean = re.sub(r"\"\s*\"", '', format_string)
     matches = list(re.finditer(r"\"((?:(?=(?:\\)*)\\.|.)*?)\"", format_string_clean))
 
@@ -226,16 +343,22 @@ def extract_templates_from_format_string(format_string: str, logging_function: d
         concatenated = re.sub(rule, placeholder, concatenated)
 
     # Don't forget to remove markers where not wanted
-    regex = regexify_format_str(concatenated, logging_function).replace(r"\$\$", '')
+    regex, variables = regexify_format_str(concatenated, logging_function)
+    regex = regex.replace(r"\$\$", '')
     amulog_tpl = formatstring2amulog(concatenated.replace("\n", ""), logging_function)
 
-    return regex, amulog_tpl
+    return regex, amulog_tpl, variables
 
 
 def log2words(log: str) -> list[str]:
     return re.split(r"\s+", log.strip(" \n\t"))  # Remove all multiple spaces
 
 
+def words_shape(words: list[str]) -> tuple[str, ...]:
+    # Logs printed by the same call site mostly differ by their numbers (counters, addresses, ids...)
+    return tuple("**" if DIGIT.search(word) else word for word in words)
+
+
 def formatstring2amulog(format_string: str, logging_function) -> str:
     words = log2words(format_string)
 
@@ -253,6 +376,42 @@ def formatstring2amulog(format_string: str, logging_function) -> str:
     return res
 
 
+SPEC_CONVERSIONS = ( "diu", "o", "xXp", "aA", "fFeEgG" )  # Specifiers whose values are decoded the same way
+
+
+def merge_variable_specs(variables_lists: list[list[tuple[int, str]]]) -> list[tuple[int, str | None]]:
+    # Specifiers decoded differently can give the same regex (e.g. %d and %o), a group whose occurrences
+    # disagree gets None and its value is kept as a string
+    merged = []
+    for variables in zip(*variables_lists):
+        group, spec = variables[0]
+        conversions = { next((kind for kind in SPEC_CONVERSIONS if other in kind), "s") for _, other in variables }
+        merged.append(( group, spec if len(conversions) == 1 else None ))
+
+    return merged
+
+
+def convert_variable(spec: str | None, value: str):
+    if spec is None:
+        return value
+
+    try:
+        if spec in "diu":
+            return int(value)
+        elif spec == "o":
+            return int(value, 8)
+        elif spec in "xXp":
+            return int(value, 16)
+        elif spec in "aA":
+            return float.fromhex(value)
+        elif spec in "fFeEgG":
+            return float(value)
+    except ValueError:
+        pass  # e.g. an octal value with an 8 in it, keep the string as is
+
+    return value
+
+
 def is_generic_format_string(string, special_rules):
     for rule in special_rules:
         string = re.sub(rule, '', string)
@@ -276,6 +435,69 @@ def template_sorter(regex: str) -> float:
     return pos
 
 
+def longest_literal(regex: str) -> str:
+    """
+    Longest string any match of `regex` has to contain, used to discard lines before running the regex.
+    """
+
+    literals = [ "" ]
+    for op, value in sre_parse.parse(regex):
+        if op == sre_constants.LITERAL:
+            literals[-1] += chr(value)
+        elif literals[-1] != "":
+            literals.append("")  # Variable part, the next literal is a new one
+
+    return max(literals, key=len)
+
+
+def count_lazy_groups(regex: str) -> int:
+    # With k lazy groups, a failing match can backtrack in O(n^k) on a line of length n
+    return regex.count(LAZY_GROUP)
+
+
+def harden_template(regex: str) -> str:
+    """
+    Rewrite a regex template into an equivalent one that backtracks less on lines it does not match.
+    Only adjacent lazy groups and digit runs followed by a literal are rewritten: chains of lazy groups
+    separated by literals, e.g. `(.*?)\\ (.*?)\\ (.*?)`, are left as is since `%s` may contain the separator.
+    """
+
+    # Two adjacent lazy groups: the first one always ends up empty, but it is retried for every length
+    while LAZY_GROUP * 2 in regex:
+        regex = regex.replace(LAZY_GROUP * 2, "()" + LAZY_GROUP)
+
+    if sys.version_info < (3, 11):
+        return regex  # Possessive quantifiers were introduced in Python 3.11
+
+    # A repetition can be made possessive when it is directly followed by a mandatory character it
+    # cannot match, since giving characters back would never let the rest of the pattern match
+    for repetition, charset in POSSESSIVE_CANDIDATES.items():
+        res = ""
+        i = 0
+        for match in re.finditer(re.escape(repetition) + r"(?=\))", regex):
+            following = regex[match.end() + 1:]
+            res += regex[i:match.end()]
+
+            if following == "$":
+                res += "+"
+            elif following:
+                if following[0] == "\\":
+                    char, quantifier = following[1:2], following[2:3]
+                    literal = not char.isalnum()
+                else:
+                    char, quantifier = following[0], following[1:2]
+                    literal = char not in "()[]{}.^$|?*+"
+
+                if literal and quantifier not in ( "?", "*", "+", "{" ) and char not in charset:
+                    res += "+"
+
+            i = match.end()
+
+        regex = res + regex[i:]
+
+    return regex
+
+
 def find_end_of_function_call(code: str) -> int:
     quotes_count = 0
     parenthesis_count = 0
@@ -302,9 +524,12 @@ WILDCARD_REGEX = re.compile(re.escape(Config.SPE_CHAR))
 WHITESPACE_REGEX = re.compile(r"\s+")
 
 
-def reformat_template(pattern, message):
+def reformat_template(pattern, message, matchobj=None):
+    import numpy  # Only needed by the regex fallback
+
     # match variable parts of the message with given template
-    matchobj = re.match(pattern, message)
+    if matchobj is None:
+        matchobj = re.match(pattern, message)
     assert matchobj is not None
 
     # get boolean index of variable part in the message